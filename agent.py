@@ -7,16 +7,40 @@ Uses Azure OpenAI Image Edit API with multi-image support (REST API).
 TODO: Transition to hosted agent in next iteration.
 """
 
+import io
 import os
-import base64
+import time
+import uuid
+import binascii
+import functools
+import itertools
+import threading
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from PIL import Image
 from dotenv import load_dotenv
 from azure.identity import DefaultAzureCredential
 
 load_dotenv()
 
+# Response bytes read per chunk while streaming the generated image to disk
+B64_CHUNK_SIZE = 64 * 1024
+B64_JSON_KEY = b'"b64_json"'
+
+# Refresh the cached bearer token when it is this close to expiring (seconds)
+TOKEN_REFRESH_SKEW = 60
+TOKEN_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# Input images are downscaled to this longest edge before upload;
+# larger sources only inflate the request body
+MAX_INPUT_EDGE = 1024
+INPUT_JPEG_QUALITY = 85
+
+# Cap on concurrent Image Edit API calls, so bursts queue here instead of
+# running into the deployment's rate limit (429s)
+MAX_CONCURRENT_GENERATIONS = int(os.environ.get("AOAI_MAX_CONCURRENCY", "5"))
+
 
 def create_session_with_retries():
     """Create a requests session with retry logic."""
@@ -27,12 +51,107 @@ def create_session_with_retries():
         status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods=["POST"]
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=32, max_retries=retries)
     session.mount("https://", adapter)
     session.mount("http://", adapter)
     return session
 
 
+# Shared session so keep-alive connections are reused across generations
+_SESSION = create_session_with_retries()
+
+# Shared credential and cached token so auth stays off the per-call path
+_CREDENTIAL = DefaultAzureCredential()
+_TOKEN = None
+_TOKEN_LOCK = threading.Lock()
+
+_GENERATION_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_GENERATIONS)
+
+
+def get_access_token() -> str:
+    """Return a cached Azure AD token, refreshing it shortly before expiry."""
+    global _TOKEN
+    with _TOKEN_LOCK:
+        if _TOKEN is None or _TOKEN.expires_on - time.time() < TOKEN_REFRESH_SKEW:
+            _TOKEN = _CREDENTIAL.get_token(TOKEN_SCOPE)
+        return _TOKEN.token
+
+
+def write_b64_json_to_file(chunks, output_path: str) -> bool:
+    """
+    Scan streamed JSON response chunks for the first "b64_json" string and
+    decode it into output_path as it arrives, without buffering the body.
+    output_path only appears once the image is complete.
+    Returns False if the response has no b64_json string.
+    """
+    chunks = iter(chunks)
+    
+    # Find the opening quote of the b64_json value
+    buf = b""
+    for chunk in chunks:
+        buf += chunk
+        key_pos = buf.find(B64_JSON_KEY)
+        if key_pos == -1:
+            # Keep a tail in case the key is split across chunks
+            buf = buf[-len(B64_JSON_KEY):]
+            continue
+        value_pos = buf.find(b'"', key_pos + len(B64_JSON_KEY))
+        if value_pos != -1:
+            if buf[key_pos + len(B64_JSON_KEY):value_pos].strip() != b":":
+                return False
+            buf = buf[value_pos + 1:]
+            break
+    else:
+        return False
+    
+    # Decode up to the closing quote, carrying partial base64 quads between chunks.
+    # Write to a temp file and rename it into place, so readers never see a
+    # partially written image
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    f = open(tmp_path, "wb")
+    try:
+        with f:
+            pending = b""
+            for chunk in itertools.chain((buf,), chunks):
+                end = chunk.find(b'"')
+                # Base64 never contains a backslash; drop JSON's optional "\/" escaping
+                pending += (chunk if end == -1 else chunk[:end]).replace(b"\\", b"")
+                aligned = len(pending) - len(pending) % 4
+                f.write(binascii.a2b_base64(pending[:aligned]))
+                pending = pending[aligned:]
+                if end != -1:
+                    break
+            else:
+                raise ValueError("Image data in response was truncated")
+            if pending:
+                raise ValueError("Image data in response is not valid base64")
+        os.replace(tmp_path, output_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+def load_upload_image(img_path: str) -> bytes:
+    """
+    Return JPEG bytes for an input image, downscaled to MAX_INPUT_EDGE.
+    Results are cached until the source file changes.
+    """
+    stat = os.stat(img_path)
+    return _resize_image(img_path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=128)
+def _resize_image(img_path: str, mtime_ns: int, size: int) -> bytes:
+    """Downscale and re-encode one image (mtime_ns and size only key the cache)."""
+    with Image.open(img_path) as im:
+        im = im.convert("RGB")
+    im.thumbnail((MAX_INPUT_EDGE, MAX_INPUT_EDGE), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    im.save(buf, "JPEG", quality=INPUT_JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
 def generate_outfit_image(image_paths: list[str], output_path: str) -> str:
     """
     Generates a combined outfit image from multiple clothing item images.
@@ -57,11 +176,6 @@ def generate_outfit_image(image_paths: list[str], output_path: str) -> str:
     
     url = f"{api_base}/openai/deployments/{deployment}/images/edits?api-version={api_version}"
     
-    # Auth
-    credential = DefaultAzureCredential()
-    token = credential.get_token("https://cognitiveservices.azure.com/.default").token
-    headers = {"Authorization": f"Bearer {token}"}
-    
     # Build prompt
     item_names = [os.path.splitext(os.path.basename(p))[0] for p in image_paths]
     prompt = f"""Create a professional fashion photo of a female model wearing: {", ".join(item_names)}
@@ -74,33 +188,33 @@ def generate_outfit_image(image_paths: list[str], output_path: str) -> str:
     print(f"🎨 Calling Image Edit API with {len(image_paths)} images...")
     
     # Multi-image upload
-    files = []
-    file_handles = []
-    session = create_session_with_retries()
+    files = [
+        ("image[]", (os.path.basename(img_path), load_upload_image(img_path), "image/jpeg"))
+        for img_path in image_paths
+    ]
+    
+    data = {
+        "prompt": prompt,
+        "n": 1,
+        "size": "1024x1536",
+        "quality": "high"
+    }
+    
+    if not _GENERATION_SLOTS.acquire(blocking=False):
+        print(f"⏳ All {MAX_CONCURRENT_GENERATIONS} generation slots busy, waiting...")
+        _GENERATION_SLOTS.acquire()
     try:
-        for img_path in image_paths:
-            fh = open(img_path, "rb")
-            file_handles.append(fh)
-            files.append(("image[]", (os.path.basename(img_path), fh, "image/jpeg")))
-        
-        data = {
-            "prompt": prompt,
-            "n": 1,
-            "size": "1024x1536",
-            "quality": "high"
-        }
+        # Auth (after queueing, so a long wait can't outlive the token)
+        headers = {"Authorization": f"Bearer {get_access_token()}"}
         
         # Use longer timeout for image generation (5 minutes)
-        response = session.post(url, headers=headers, files=files, data=data, timeout=300)
+        response = _SESSION.post(url, headers=headers, files=files, data=data, timeout=300, stream=True)
+    finally:
+        _GENERATION_SLOTS.release()
+    
+    with response:
         response.raise_for_status()
-        
-        result = response.json()
-        if result.get("data") and result["data"][0].get("b64_json"):
-            with open(output_path, "wb") as f:
-                f.write(base64.b64decode(result["data"][0]["b64_json"]))
+        if write_b64_json_to_file(response.iter_content(chunk_size=B64_CHUNK_SIZE), output_path):
             return output_path
-        
-        raise ValueError("No image in response")
-    finally:
-        for fh in file_handles:
-            fh.close()
+    
+    raise ValueError("No image in response")
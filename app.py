@@ -6,11 +6,14 @@ Flask backend serving the frontend and API endpoints.
 import os
 import json
 import uuid
-import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 from flask import Flask, render_template, jsonify, request, send_from_directory
 from flask_cors import CORS
 from agent import generate_outfit_image
-from fabric_client import get_fabric_client
+from fabric_client import get_fabric_client, combination_id_from_ids
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 CORS(app)
@@ -20,6 +23,16 @@ PRODUCTS_FOLDER = './static/products'
 GENERATED_FOLDER = './static/generated'
 CATALOG_FILE = './data/catalog.json'
 
+# Browser cache lifetimes for images (seconds)
+GENERATED_MAX_AGE = 31536000  # look_<combination_id> files never change
+PRODUCT_MAX_AGE = 86400
+
+# Number of generated looks kept in the in-memory cache
+LOOK_CACHE_SIZE = 2048
+
+# Background threads running image generation jobs
+GENERATION_WORKERS = 8
+
 # Ensure folders exist
 os.makedirs(GENERATED_FOLDER, exist_ok=True)
 os.makedirs(PRODUCTS_FOLDER, exist_ok=True)
@@ -36,30 +49,123 @@ CATEGORY_NAMES = {
 
 
 def load_catalog():
-    """Load product catalog from JSON file."""
+    """
+    Load product catalog from JSON file.
+    Returns (catalog, product_index) where product_index maps
+    product ID -> (category_id, product, image_path). image_path is None
+    when the product image is missing from PRODUCTS_FOLDER.
+    """
     if os.path.exists(CATALOG_FILE):
         with open(CATALOG_FILE, 'r', encoding='utf-8') as f:
             raw_catalog = json.load(f)
             # Transform to include category metadata
             catalog = {}
+            product_index = {}
             for category_id, products in raw_catalog.items():
+                # List the category folder once instead of a stat per lookup
+                category_path = os.path.join(PRODUCTS_FOLDER, category_id)
+                if os.path.isdir(category_path):
+                    with os.scandir(category_path) as entries:
+                        image_files = {entry.name for entry in entries}
+                else:
+                    image_files = set()
+                
                 # Calculate discount percentage if originalPrice exists
                 for product in products:
-                    if product.get('originalPrice') and product['originalPrice'] > product['price']:
-                        product['discount'] = round((1 - product['price'] / product['originalPrice']) * 100)
-                    else:
-                        product['discount'] = None
+                    original_price = product.get('originalPrice')
+                    product['discount'] = (
+                        round((1 - product['price'] / original_price) * 100)
+                        if original_price and original_price > product['price'] else None
+                    )
+                    image_path = (
+                        os.path.join(category_path, product['image'])
+                        if product.get('image') in image_files else None
+                    )
+                    product_index[product['id']] = (category_id, product, image_path)
                 
                 catalog[category_id] = {
                     "name": CATEGORY_NAMES.get(category_id, category_id.capitalize()),
                     "products": products
                 }
-            return catalog
-    return {}
+            return catalog, product_index
+    return {}, {}
 
 
 # Load catalog on startup
-CATALOG = load_catalog()
+CATALOG, PRODUCT_INDEX = load_catalog()
+
+# Pre-serialized catalog responses (CATALOG does not change after startup)
+CATEGORIES_JSON = orjson.dumps([{"id": key, "name": val["name"]} for key, val in CATALOG.items()])
+PRODUCTS_JSON = {key: orjson.dumps(val["products"]) for key, val in CATALOG.items()}
+
+# combination_id -> look response payload, most recently used last
+_LOOK_CACHE = OrderedDict()
+_LOOK_CACHE_LOCK = threading.Lock()
+
+
+def get_cached_look(combination_id: str):
+    """Return the cached look payload for a combination, or None."""
+    with _LOOK_CACHE_LOCK:
+        look = _LOOK_CACHE.get(combination_id)
+        if look is not None:
+            _LOOK_CACHE.move_to_end(combination_id)
+        return look
+
+
+def remember_look(combination_id: str, look: dict):
+    """Store a look payload, evicting the least recently used one when full."""
+    with _LOOK_CACHE_LOCK:
+        _LOOK_CACHE[combination_id] = look
+        _LOOK_CACHE.move_to_end(combination_id)
+        if len(_LOOK_CACHE) > LOOK_CACHE_SIZE:
+            _LOOK_CACHE.popitem(last=False)
+
+
+# Generation jobs run off the request thread; job_id is the combination_id,
+# so identical concurrent requests share one job
+_EXECUTOR = ThreadPoolExecutor(max_workers=GENERATION_WORKERS)
+_JOBS = {}
+_JOBS_LOCK = threading.Lock()
+
+
+def run_generation_job(combination_id: str, image_paths: list, products_info: list, cached_path: str) -> dict:
+    """Generate a look in the background and cache the resulting payload."""
+    try:
+        print(f"🔄 Generating new look for combination {combination_id}...")
+        generate_outfit_image(image_paths, cached_path)
+    except Exception as e:
+        print(f"❌ Error generating look: {e}")
+        raise
+    
+    look = {
+        "success": True,
+        "image": f"/static/generated/{os.path.basename(cached_path)}",
+        "products": products_info,
+        "combination_id": combination_id
+    }
+    remember_look(combination_id, look)
+    # Finished jobs are served from the look cache; failed ones stay
+    # in _JOBS so pollers can see the error
+    with _JOBS_LOCK:
+        _JOBS.pop(combination_id, None)
+    return look
+
+
+def ojsonify(obj):
+    """Like jsonify, but serialized with orjson for the larger catalog payloads."""
+    return app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+
+@app.after_request
+def add_image_cache_headers(response):
+    """Let browsers cache product and generated images instead of re-fetching them."""
+    if response.status_code not in (200, 304):
+        return response
+    if request.path.startswith('/static/generated/look_'):
+        response.headers['Cache-Control'] = f'public, max-age={GENERATED_MAX_AGE}, immutable'
+    elif request.path.startswith(('/static/products/', '/products/')):
+        response.headers['Cache-Control'] = f'public, max-age={PRODUCT_MAX_AGE}'
+    return response
 
 
 @app.route('/')
@@ -71,26 +177,24 @@ def index():
 @app.route('/api/categories')
 def get_categories():
     """Get all categories."""
-    categories = [{"id": key, "name": val["name"]} for key, val in CATALOG.items()]
-    return jsonify(categories)
+    return app.response_class(CATEGORIES_JSON, mimetype='application/json')
 
 
 @app.route('/api/products/<category>')
 def get_products(category):
     """Get products for a category."""
-    if category not in CATALOG:
+    if category not in PRODUCTS_JSON:
         return jsonify({"error": "Category not found"}), 404
-    return jsonify(CATALOG[category]["products"])
+    return app.response_class(PRODUCTS_JSON[category], mimetype='application/json')
 
 
 @app.route('/api/product/<product_id>')
 def get_product(product_id):
     """Get a single product by ID."""
-    for category_id, category in CATALOG.items():
-        for product in category["products"]:
-            if product["id"] == product_id:
-                return jsonify(product)
-    return jsonify({"error": "Product not found"}), 404
+    entry = PRODUCT_INDEX.get(product_id)
+    if entry is None:
+        return jsonify({"error": "Product not found"}), 404
+    return ojsonify(entry[1])
 
 
 def generate_combination_id(item_ids: list) -> str:
@@ -98,10 +202,8 @@ def generate_combination_id(item_ids: list) -> str:
     Generate a deterministic combination_id based on the item IDs.
     Same items will always produce the same combination_id.
     """
-    sorted_ids = sorted(item_ids)
-    items_string = "|".join(sorted_ids)
-    hash_digest = hashlib.sha256(items_string.encode()).hexdigest()
-    return f"{hash_digest[:8]}-{hash_digest[8:12]}-{hash_digest[12:16]}-{hash_digest[16:20]}-{hash_digest[20:32]}"
+    # Same hash as the Fabric client, so look cache keys match Fabric's IDs
+    return combination_id_from_ids(tuple(sorted(item_ids)))
 
 
 @app.route('/api/generate', methods=['POST'])
@@ -118,56 +220,87 @@ def generate_look():
     cached_filename = f"look_{combination_id}.jpeg"
     cached_path = os.path.join(GENERATED_FOLDER, cached_filename)
     
+    # In-memory cache hit skips the disk check and product resolution
+    look = get_cached_look(combination_id)
+    if look is not None:
+        return jsonify({**look, "cached": True})
+    
+    # Check if this combination was already generated (cache hit)
+    if os.path.exists(cached_path):
+        products_info = [PRODUCT_INDEX[item_id][1] for item_id in selected_items if item_id in PRODUCT_INDEX]
+        print(f"✅ Cache hit! Returning existing image for combination {combination_id}")
+        look = {
+            "success": True,
+            "image": f"/static/generated/{cached_filename}",
+            "products": products_info,
+            "combination_id": combination_id
+        }
+        remember_look(combination_id, look)
+        return jsonify({**look, "cached": True})
+    
     # Map product IDs to image paths and product info
     image_paths = []
     products_info = []
     
     for item_id in selected_items:
-        for category_id, category in CATALOG.items():
-            for product in category["products"]:
-                if product["id"] == item_id:
-                    img_path = os.path.join(PRODUCTS_FOLDER, category_id, product["image"])
-                    if os.path.exists(img_path):
-                        image_paths.append(img_path)
-                        products_info.append(product)
-                    break
+        entry = PRODUCT_INDEX.get(item_id)
+        if entry is None:
+            continue
+        _, product, img_path = entry
+        if img_path:
+            image_paths.append(img_path)
+            products_info.append(product)
     
     if not image_paths:
         return jsonify({"error": "No images available for selected products"}), 400
     
-    # Check if this combination was already generated (cache hit)
-    if os.path.exists(cached_path):
-        print(f"✅ Cache hit! Returning existing image for combination {combination_id}")
-        return jsonify({
-            "success": True,
-            "image": f"/static/generated/{cached_filename}",
-            "products": products_info,
-            "cached": True,
-            "combination_id": combination_id
-        })
+    # Cache miss - start (or join) a background generation job
+    with _JOBS_LOCK:
+        job = _JOBS.get(combination_id)
+        if job is None or (job.done() and job.exception() is not None):
+            # A job for this combination may have finished since the cache checks above
+            look = get_cached_look(combination_id)
+            if look is None:
+                _JOBS[combination_id] = _EXECUTOR.submit(
+                    run_generation_job, combination_id, image_paths, products_info, cached_path
+                )
     
-    # Cache miss - generate new image
-    try:
-        print(f"🔄 Generating new look for combination {combination_id}...")
-        generate_outfit_image(image_paths, cached_path)
-        
-        return jsonify({
-            "success": True,
-            "image": f"/static/generated/{cached_filename}",
-            "products": products_info,
-            "cached": False,
-            "combination_id": combination_id
-        })
-    except Exception as e:
-        print(f"❌ Error generating look: {e}")
-        return jsonify({"error": str(e)}), 500
+    if look is not None:
+        return jsonify({**look, "cached": True})
+    
+    return jsonify({
+        "success": True,
+        "status": "pending",
+        "job_id": combination_id,
+        "combination_id": combination_id
+    }), 202
+
+
+@app.route('/api/generate/<job_id>')
+def get_generation_status(job_id):
+    """Poll a generation job started by POST /api/generate."""
+    with _JOBS_LOCK:
+        job = _JOBS.get(job_id)
+    
+    if job is not None:
+        if not job.done():
+            return jsonify({"success": True, "status": "pending", "job_id": job_id}), 202
+        if job.exception() is not None:
+            return jsonify({"error": str(job.exception())}), 500
+        return jsonify({**job.result(), "cached": False})
+    
+    # Completed jobs are removed from _JOBS once their look is cached
+    look = get_cached_look(job_id)
+    if look is not None:
+        return jsonify({**look, "cached": False})
+    return jsonify({"error": "Job not found"}), 404
 
 
 @app.route('/products/<category>/<filename>')
 def serve_product_image(category, filename):
     """Serve product images from category subfolders."""
     category_path = os.path.join(PRODUCTS_FOLDER, category)
-    return send_from_directory(category_path, filename)
+    return send_from_directory(category_path, filename, conditional=True)
 
 
 @app.route('/api/combination', methods=['POST'])
@@ -244,4 +377,4 @@ def place_order():
 if __name__ == '__main__':
     print("🚀 Starting Virtual Try-On Web Server...")
     print("📍 Open http://localhost:5000 in your browser")
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True, host='0.0.0.0', port=5000)
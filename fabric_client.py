@@ -5,18 +5,66 @@ Uses connection strings for authentication (required for external apps).
 """
 
 import os
-import json
 import uuid
+import logging
+import atexit
+import threading
 import hashlib
+import functools
+import orjson
 from azure.eventhub import EventHubProducerClient, EventData
+from azure.eventhub.exceptions import EventHubError
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Event Hub connection strings from environment variables
 EH_SALES_CONNECTION_STRING = os.environ.get("FABRIC_EH_SALES_CONNECTION_STRING", "")
 EH_COMBINATIONS_CONNECTION_STRING = os.environ.get("FABRIC_EH_COMBINATIONS_CONNECTION_STRING", "")
 
+# Fabric Eventstream Custom App sources read event bodies as JSON
+EVENT_CONTENT_TYPE = "application/json"
+
+# Producers buffer events and send them in batches at least this often (seconds)
+EH_MAX_WAIT_TIME = 1.0
+
+# AMQP send retries for transient Event Hub errors
+EH_RETRY_TOTAL = 3
+EH_RETRY_BACKOFF_FACTOR = 0.3
+
+
+def make_event(payload: dict) -> EventData:
+    """Serialize a payload into an EventData tagged with its content type."""
+    event = EventData(orjson.dumps(payload))
+    event.content_type = EVENT_CONTENT_TYPE
+    return event
+
+
+def build_event_items(items: list) -> list:
+    """Convert cart items from the frontend into the event item schema."""
+    return [
+        {
+            "product_id": item.get("id", ""),
+            "name": item.get("name", ""),
+            "price": float(item.get("price") or 0),
+            "color": item.get("color", "")
+        }
+        for item in items
+    ]
+
+
+@functools.lru_cache(maxsize=4096)
+def combination_id_from_ids(sorted_ids: tuple) -> str:
+    """
+    Hash a sorted tuple of product IDs into a UUID-like combination_id.
+    Memoized, since users try the same outfits again and again.
+    """
+    items_string = "|".join(sorted_ids)
+    digest = hashlib.blake2b(items_string.encode(), digest_size=16).digest()
+    return str(uuid.UUID(bytes=digest))
+
 
 class FabricClient:
     """Client for sending data to Microsoft Fabric Event Hubs."""
@@ -25,30 +73,60 @@ class FabricClient:
         self._sales_producer = None
         self._combinations_producer = None
         self._initialized = False
+        self._init_lock = threading.Lock()
     
     def _initialize(self):
         """Initialize the Event Hub producers using connection strings."""
         if self._initialized:
             return
         
-        try:
-            # Create Event Hub producers using connection strings
-            if EH_SALES_CONNECTION_STRING:
-                self._sales_producer = EventHubProducerClient.from_connection_string(
-                    conn_str=EH_SALES_CONNECTION_STRING
-                )
-            
-            if EH_COMBINATIONS_CONNECTION_STRING:
-                self._combinations_producer = EventHubProducerClient.from_connection_string(
-                    conn_str=EH_COMBINATIONS_CONNECTION_STRING
-                )
-            
-            self._initialized = True
-            print("✅ Fabric Event Hub client initialized successfully")
+        with self._init_lock:
+            # Another thread may have initialized while we waited for the lock
+            if self._initialized:
+                return
             
-        except Exception as e:
-            print(f"⚠️ Failed to initialize Fabric client: {e}")
-            raise
+            try:
+                # Create Event Hub producers using connection strings
+                if EH_SALES_CONNECTION_STRING:
+                    self._sales_producer = self._create_producer(EH_SALES_CONNECTION_STRING)
+                else:
+                    logger.warning("⚠️ FABRIC_EH_SALES_CONNECTION_STRING not set, orders will not be sent to Fabric")
+                
+                if EH_COMBINATIONS_CONNECTION_STRING:
+                    self._combinations_producer = self._create_producer(EH_COMBINATIONS_CONNECTION_STRING)
+                else:
+                    logger.warning("⚠️ FABRIC_EH_COMBINATIONS_CONNECTION_STRING not set, combinations will not be sent to Fabric")
+                
+                self._initialized = True
+                logger.info("✅ Fabric Event Hub client initialized successfully")
+                
+            except Exception as e:
+                logger.warning("⚠️ Failed to initialize Fabric client: %s", e)
+                raise
+    
+    def _create_producer(self, conn_str: str) -> EventHubProducerClient:
+        """
+        Create a buffered Event Hub producer. Events are batched and sent from
+        a background thread; the client keeps its AMQP connection open across
+        requests.
+        """
+        return EventHubProducerClient.from_connection_string(
+            conn_str=conn_str,
+            buffered_mode=True,
+            max_wait_time=EH_MAX_WAIT_TIME,
+            on_success=self._on_send_success,
+            on_error=self._on_send_error,
+            retry_total=EH_RETRY_TOTAL,
+            retry_backoff_factor=EH_RETRY_BACKOFF_FACTOR
+        )
+    
+    def _on_send_success(self, events: list, partition_id: str):
+        """Called by a buffered producer after a batch was sent."""
+        logger.debug("📤 Sent %d event(s) to Fabric (partition %s)", len(events), partition_id)
+    
+    def _on_send_error(self, events: list, partition_id: str, error: Exception):
+        """Called by a buffered producer when a batch could not be sent."""
+        logger.error("❌ Failed to send %d event(s) to Fabric (partition %s): %s", len(events), partition_id, error)
     
     def _generate_combination_id(self, items: list) -> str:
         """
@@ -56,56 +134,49 @@ class FabricClient:
         Same items will always produce the same combination_id.
         """
         # Sort items by product_id to ensure consistent ordering
-        sorted_ids = sorted([item.get("id", "") for item in items])
-        # Create a hash of the sorted product IDs
-        items_string = "|".join(sorted_ids)
-        hash_digest = hashlib.sha256(items_string.encode()).hexdigest()
-        # Return first 32 chars as a UUID-like string
-        return f"{hash_digest[:8]}-{hash_digest[8:12]}-{hash_digest[12:16]}-{hash_digest[16:20]}-{hash_digest[20:32]}"
+        return combination_id_from_ids(tuple(sorted(item.get("id", "") for item in items)))
     
     def send_combination(self, user_id: str, items: list) -> str:
         """
-        Send a combination (outfit) to the Combinations event stream.
+        Queue a combination (outfit) for the Combinations event stream.
+        The event is sent in the background with the next batch.
         
         Args:
             user_id: The user identifier
             items: List of items with product_id, name, price, color
             
         Returns:
-            The generated combination_id (deterministic based on items)
+            The generated combination_id (deterministic based on items).
+            Returned without sending if the Combinations stream is not configured.
         """
         self._initialize()
         
         # Generate deterministic combination_id based on items
         combination_id = self._generate_combination_id(items)
         
+        if self._combinations_producer is None:
+            logger.debug("Combinations stream not configured, skipping combination %s", combination_id)
+            return combination_id
+        
         combination_data = {
             "combination_id": combination_id,
             "user_id": user_id,
-            "items": [
-                {
-                    "product_id": item.get("id", ""),
-                    "name": item.get("name", ""),
-                    "price": float(item.get("price", 0)),
-                    "color": item.get("color", "")
-                }
-                for item in items
-            ]
+            "items": build_event_items(items)
         }
         
         try:
-            event_data_batch = self._combinations_producer.create_batch()
-            event_data_batch.add(EventData(json.dumps(combination_data)))
-            self._combinations_producer.send_batch(event_data_batch)
-            print(f"📤 Sent combination {combination_id} to Fabric")
+            # Partition by user so each user's events stay in order
+            self._combinations_producer.send_event(make_event(combination_data), partition_key=user_id)
+            logger.debug("📤 Queued combination %s for Fabric", combination_id)
             return combination_id
-        except Exception as e:
-            print(f"❌ Failed to send combination: {e}")
+        except EventHubError:
+            logger.exception("❌ Failed to queue combination %s", combination_id)
             raise
     
     def send_order(self, user_id: str, combination_id: str, items: list) -> str:
         """
-        Send an order to the Sales event stream.
+        Queue an order for the Sales event stream.
+        The event is sent in the background with the next batch.
         
         Args:
             user_id: The user identifier
@@ -113,39 +184,42 @@ class FabricClient:
             items: List of items with product_id, name, price, color
             
         Returns:
-            The generated order_id
+            The generated order_id. Returned without sending if the Sales
+            stream is not configured.
         """
         self._initialize()
         
         order_id = str(uuid.uuid4())
         
+        if self._sales_producer is None:
+            logger.debug("Sales stream not configured, skipping order %s", order_id)
+            return order_id
+        
         order_data = {
             "order_id": order_id,
             "combination_id": combination_id,
             "user_id": user_id,
-            "items": [
-                {
-                    "product_id": item.get("id", ""),
-                    "name": item.get("name", ""),
-                    "price": float(item.get("price", 0)),
-                    "color": item.get("color", "")
-                }
-                for item in items
-            ]
+            "items": build_event_items(items)
         }
         
         try:
-            event_data_batch = self._sales_producer.create_batch()
-            event_data_batch.add(EventData(json.dumps(order_data)))
-            self._sales_producer.send_batch(event_data_batch)
-            print(f"📤 Sent order {order_id} to Fabric")
+            # Partition by user so each user's events stay in order
+            self._sales_producer.send_event(make_event(order_data), partition_key=user_id)
+            logger.debug("📤 Queued order %s for Fabric", order_id)
             return order_id
-        except Exception as e:
-            print(f"❌ Failed to send order: {e}")
+        except EventHubError:
+            logger.exception("❌ Failed to queue order %s", order_id)
             raise
     
+    def flush(self):
+        """Send all buffered events now."""
+        if self._sales_producer:
+            self._sales_producer.flush()
+        if self._combinations_producer:
+            self._combinations_producer.flush()
+    
     def close(self):
-        """Close the Event Hub producers."""
+        """Flush buffered events and close the Event Hub producers."""
         if self._sales_producer:
             self._sales_producer.close()
         if self._combinations_producer:
@@ -155,11 +229,16 @@ class FabricClient:
 
 # Singleton instance
 _fabric_client = None
+_fabric_client_lock = threading.Lock()
 
 
 def get_fabric_client() -> FabricClient:
     """Get the singleton Fabric client instance."""
     global _fabric_client
     if _fabric_client is None:
-        _fabric_client = FabricClient()
+        with _fabric_client_lock:
+            if _fabric_client is None:
+                _fabric_client = FabricClient()
+                # Don't lose buffered events on shutdown
+                atexit.register(_fabric_client.close)
     return _fabric_client
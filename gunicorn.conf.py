@@ -0,0 +1,19 @@
+"""
+Gunicorn configuration for the Virtual Try-On web app.
+Usage: gunicorn app:app
+"""
+
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+
+# Threaded workers: look generation is I/O-bound (waiting on Azure OpenAI),
+# so threads let one worker serve many requests while others wait.
+# Generation jobs and the look cache live in process memory, so a single
+# worker keeps /api/generate/<job_id> polls on the process that owns the job.
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+
+# Image generation can take several minutes
+timeout = 360
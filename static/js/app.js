@@ -415,7 +415,13 @@ class VirtualTryOnApp {
                 throw new Error(error.error || 'Failed to generate look');
             }
 
-            const result = await response.json();
+            let result = await response.json();
+
+            // New looks are generated in the background - poll until ready
+            if (response.status === 202) {
+                result = await this.waitForLook(result.job_id);
+            }
+
             this.generatedLook = result;
             
             // Log cache status
@@ -448,6 +454,22 @@ class VirtualTryOnApp {
         }
     }
 
+    async waitForLook(jobId) {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 2000));
+
+            const response = await fetch(`/api/generate/${jobId}`);
+            const result = await response.json();
+
+            if (!response.ok) {
+                throw new Error(result.error || 'Failed to generate look');
+            }
+            if (response.status !== 202) {
+                return result;
+            }
+        }
+    }
+
     async sendCombinationToFabric(items) {
         try {
             const response = await fetch('/api/combination', {